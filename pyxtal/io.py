@@ -3,17 +3,19 @@ This module handles reading and write crystal files.
 """
 
 import importlib.resources
+from functools import lru_cache
 
 import numpy as np
 from monty.serialization import loadfn
-from pymatgen.core.bonds import CovalentBond
+from pymatgen.core.bonds import bond_lengths
+from pymatgen.core.periodic_table import Element
 from pymatgen.core.structure import Molecule, Structure
 
 from pyxtal.constants import logo
 from pyxtal.lattice import Lattice
 from pyxtal.molecule import Orientation, compare_mol_connectivity, pyxtal_molecule
 from pyxtal.msg import ReadSeedError
-from pyxtal.symmetry import Group
+from pyxtal.symmetry import Group, get_wyckoffs
 from pyxtal.util import get_symmetrized_pmg
 from pyxtal.wyckoff_site import atom_site, mol_site
 
@@ -21,6 +23,27 @@ with importlib.resources.as_file(importlib.resources.files("pyxtal") / "database
     bonds = loadfn(path)
 
 
+def _get_bond_tables():
+    """
+    Bond length tables indexed by the atomic numbers of (center, neighbor),
+    NaN means no data. The first uses the longest bond in pymatgen, the
+    second uses our own bond distance lib.
+    """
+    pmg_table = np.full([119, 119], np.nan)
+    for (sp0, sp1), lengths in bond_lengths.items():
+        z0, z1 = Element(sp0).Z, Element(sp1).Z
+        pmg_table[z0, z1] = pmg_table[z1, z0] = max(lengths.values())
+
+    table = np.full([119, 119], np.nan)
+    for key, d in bonds.items():
+        sp1, sp0 = key.split("-")
+        table[Element(sp0).Z, Element(sp1).Z] = d
+    return pmg_table, table
+
+
+pmg_bond_table, bond_table = _get_bond_tables()
+
+
 def in_merged_coords(wp, pt, pts, cell):
     """
     Whether or not the pt in within the pts
@@ -34,6 +57,40 @@ def in_merged_coords(wp, pt, pts, cell):
     return False
 
 
+@lru_cache(maxsize=None)
+def get_xyz_strs(number, dim=3):
+    """
+    Cached xyz strings of the general position in the standard setting,
+    which are fixed for a given group
+
+    Args:
+        number: the international group number
+        dim: dimension [0, 1, 2, 3]
+
+    Returns:
+        a tuple of xyz strings
+    """
+    return tuple(op.as_xyz_str() for op in get_wyckoffs(number, dim=dim)[0])
+
+
+@lru_cache(maxsize=None)
+def get_affine_matrices(number, dim=3):
+    """
+    Cached affine matrices of the general position in the standard setting,
+    used as a quick signature to recognize the standard setting
+
+    Args:
+        number: the international group number
+        dim: dimension [0, 1, 2, 3]
+
+    Returns:
+        a read-only array of shape (N, 4, 4)
+    """
+    matrices = np.array([op.affine_matrix for op in get_wyckoffs(number, dim=dim)[0]])
+    matrices.setflags(write=False)
+    return matrices
+
+
 def get_cif_str_for_pyxtal(struc, header: str = "", sym_num=None, style: str = "mp"):
     """Get the cif string for a given structure. The default setting for
     _atom_site follows the materials project cif
@@ -56,58 +113,69 @@ def get_cif_str_for_pyxtal(struc, header: str = "", sym_num=None, style: str = "
         molecule = False
 
     if sym_num is None:
-        l_type = struc.group.lattice_type
-        number = struc.group.number
-        G1 = struc.group[0]
-        symbol = struc.group.symbol if G1.is_standard_setting() else sites[0].wp.get_hm_symbol()
+        group = struc.group
+        l_type = group.lattice_type
+        number = group.number
+        G1 = group.Wyckoff_positions[0]
+        # skip the expensive search of equivalent ops if G1 is exactly the standard one
+        ref = get_affine_matrices(number, G1.dim)
+        ops = np.array([op.affine_matrix for op in G1])
+        if (ops.shape == ref.shape and np.allclose(ops, ref)) or G1.is_standard_setting():
+            symbol = group.symbol
+            xyz_strs = get_xyz_strs(number, G1.dim)
+        else:
+            symbol = sites[0].wp.get_hm_symbol()
+            xyz_strs = [op.as_xyz_str() for op in G1]
 
     else:  # P1 symmetry
         l_type = "triclinic"
         symbol = "P1"
         number = 1
-        G1 = Group(1).Wyckoff_positions[0]
+        xyz_strs = get_xyz_strs(1)
 
-    lines = logo
-    lines += "data_" + header + "\n"
+    lines = [logo]
+    lines.append("data_" + header + "\n")
     if hasattr(struc, "energy"):
         eng = struc.energy / sum(struc.numMols) if struc.molecular else struc.energy / sum(struc.numIons)
-        lines += f"#Energy: {eng} eV/cell\n"
+        lines.append(f"#Energy: {eng} eV/cell\n")
 
-    lines += f"\n_symmetry_space_group_name_H-M '{symbol:s}'\n"
-    lines += f"_symmetry_Int_Tables_number      {number:>15d}\n"
-    lines += f"_symmetry_cell_setting           {l_type:>15s}\n"
+    lines.append(f"\n_symmetry_space_group_name_H-M '{symbol:s}'\n")
+    lines.append(f"_symmetry_Int_Tables_number      {number:>15d}\n")
+    lines.append(f"_symmetry_cell_setting           {l_type:>15s}\n")
 
     a, b, c, alpha, beta, gamma = struc.lattice.get_para(degree=True)
-    lines += f"_cell_length_a        {a:12.6f}\n"
-    lines += f"_cell_length_b        {b:12.6f}\n"
-    lines += f"_cell_length_c        {c:12.6f}\n"
-    lines += f"_cell_angle_alpha     {alpha:12.6f}\n"
-    lines += f"_cell_angle_beta      {beta:12.6f}\n"
-    lines += f"_cell_angle_gamma     {gamma:12.6f}\n"
-    lines += f"_cell_volume          {struc.lattice.volume:12.6f}\n"
+    lines.append(f"_cell_length_a        {a:12.6f}\n")
+    lines.append(f"_cell_length_b        {b:12.6f}\n")
+    lines.append(f"_cell_length_c        {c:12.6f}\n")
+    lines.append(f"_cell_angle_alpha     {alpha:12.6f}\n")
+    lines.append(f"_cell_angle_beta      {beta:12.6f}\n")
+    lines.append(f"_cell_angle_gamma     {gamma:12.6f}\n")
+    lines.append(f"_cell_volume          {struc.lattice.volume:12.6f}\n")
     # if struc.molecular:
-    #    lines += '_cell_formula_units_Z     {:d}\n'.format(sum(struc.numMols))
+    #    lines.append(f"_cell_formula_units_Z     {sum(struc.numMols):d}\n")
     # else:
-    #    lines += '_cell_formula_units_Z     {:d}\n'.format(sum(struc.numIons))
+    #    lines.append(f"_cell_formula_units_Z     {sum(struc.numIons):d}\n")
 
-    lines += "\nloop_\n"
-    lines += " _symmetry_equiv_pos_site_id\n"
-    lines += " _symmetry_equiv_pos_as_xyz\n"
+    lines.append("\nloop_\n")
+    lines.append(" _symmetry_equiv_pos_site_id\n")
+    lines.append(" _symmetry_equiv_pos_as_xyz\n")
 
-    for i, op in enumerate(G1):
-        lines += f"{i + 1:d} '{op.as_xyz_str():s}'\n"
+    for i, xyz_str in enumerate(xyz_strs):
+        lines.append(f"{i + 1:d} '{xyz_str:s}'\n")
 
-    lines += "\nloop_\n"
-    lines += " _atom_site_label\n"
-    lines += " _atom_site_type_symbol\n"
-    lines += " _atom_site_symmetry_multiplicity\n"
+    lines.append("\nloop_\n")
+    lines.append(" _atom_site_label\n")
+    lines.append(" _atom_site_type_symbol\n")
+    lines.append(" _atom_site_symmetry_multiplicity\n")
     if style == "icsd":
-        lines += " _atom_site_Wyckoff_symbol\n"
-    lines += " _atom_site_fract_x\n"
-    lines += " _atom_site_fract_y\n"
-    lines += " _atom_site_fract_z\n"
-    lines += " _atom_site_occupancy\n"
-
+        lines.append(" _atom_site_Wyckoff_symbol\n")
+    lines.append(" _atom_site_fract_x\n")
+    lines.append(" _atom_site_fract_y\n")
+    lines.append(" _atom_site_fract_z\n")
+    lines.append(" _atom_site_occupancy\n")
+
+    labels = []
+    xyzs = []
     for site in sites:
         mul = site.wp.multiplicity
         letter = site.wp.letter
@@ -140,26 +208,29 @@ def get_cif_str_for_pyxtal(struc, header: str = "", sym_num=None, style: str = "
                     coords, species = coord0s, specie0s
                     muls = [mul] * len(coords)
             else:
-                coords = None
-                species = []
-                for id in range(sym_num):
-                    mol = site.get_mol_object(id)
-                    tmp = mol.cart_coords.dot(site.lattice.inv_matrix)
-                    coords = tmp if coords is None else np.append(coords, tmp, axis=0)
-                    species.extend([s.value for s in mol.species])
+                inv_matrix = site.lattice.inv_matrix
+                get_mol = site.get_mol_object
+                mols = [get_mol(id) for id in range(sym_num)]
+                # convert all copies to fractional coordinates in one product
+                coords = np.stack([mol.cart_coords for mol in mols]).reshape(-1, 3).dot(inv_matrix)
+                species = [s.value for s in mols[0].species] * sym_num
                 muls = [mul] * len(coords)
                 # coords, species = site._get_coords_and_species(ids=sym_num)
         else:
             coords, species, muls = [site.position], [site.specie], [mul]
 
-        for specie, coord, mul in zip(species, coords, muls):
-            lines += f"{specie:6s} {specie:6s} {mul:3d} "
-            if style != "mp":
-                lines += f"{letter:s} "
-            lines += "{:12.6f}{:12.6f}{:12.6f} 1\n".format(*coord)
-    lines += "#END\n\n"
+        wyc = "" if style == "mp" else f"{letter:s} "
+        labels.extend(f"{specie:6s} {specie:6s} {mul:3d} {wyc:s}" for specie, mul in zip(species, muls))
+        xyzs.append(np.reshape(coords, (-1, 3)))
+
+    if len(labels) > 0:
+        # format all fractional coordinates with a single % operation
+        xyz = np.concatenate(xyzs).ravel().tolist()
+        fmt = "".join(label.replace("%", "%%") + "%12.6f%12.6f%12.6f 1\n" for label in labels)
+        lines.append(fmt % tuple(xyz))
+    lines.append("#END\n\n")
 
-    return lines
+    return "".join(lines)
 
 
 def write_cif(struc, filename=None, header="", permission="w", sym_num=None, style="mp"):
@@ -181,8 +252,11 @@ def write_cif(struc, filename=None, header="", permission="w", sym_num=None, sty
     if filename is None:
         return lines
     else:
+        # write the encoded text in one go, bypassing the text layer
+        if "b" not in permission:
+            permission += "b"
         with open(filename, permission) as f:
-            f.write(lines)
+            f.write(lines.encode("utf-8"))
         return None
 
 
@@ -308,12 +382,12 @@ class structure_from_ext:
 
         wps = []
         ids = []  # id for the generator
-        visited_ids = []
+        visited_ids = set()
         for id, pos in enumerate(positions):
             if id not in visited_ids:
                 centers = apply_ops(pos, self.wyc)
                 tmp_ids = find_ids(centers, positions)
-                visited_ids.extend(tmp_ids)
+                visited_ids.update(tmp_ids)
                 # print(id, pos, tmp_ids, len(self.wyc), len(molecules[id]))
                 if len(tmp_ids) == len(self.wyc):
                     # general position
@@ -340,7 +414,7 @@ class structure_from_ext:
         self.wps = []
         self.p_mols = []
         self.ids = []
-        ids_done = []
+        ids_done = set()
 
         # search for the matched molecules
         for j, mol2_ref in enumerate(self.ref_mols):
@@ -358,8 +432,12 @@ class structure_from_ext:
                     if match:
                         if len(mol1) > 1:
                             # rearrange the order
-                            order = [mapping[at] for at in range(len(mol1))]
-                            xyz = mol1.cart_coords[order]
+                            n_at = len(mol1)
+                            order = np.fromiter((mapping[at] for at in range(n_at)), dtype=np.intp, count=n_at)
+                            if np.array_equal(order, np.arange(n_at)):
+                                xyz = mol1.cart_coords
+                            else:
+                                xyz = mol1.cart_coords[order]
                             # add hydrogen positions here
                             if self.add_H:
                                 # print(mol2.smile)
@@ -373,12 +451,12 @@ class structure_from_ext:
                         else:
                             xyz = mol1.cart_coords[0]
                             position = np.dot(xyz, inv_lat)
-                        position -= np.floor(position)
+                        position %= 1.0
 
                         self.positions.append(position)
                         self.p_mols.append(p_mol)
                         self.ids.append(j)
-                        ids_done.append(id)
+                        ids_done.add(id)
 
                         self.wps.append(wps[i])
                         self.numMols[j] += len(wps[i])
@@ -459,26 +537,17 @@ class structure_from_ext:
         """
         compute the orientation wrt the reference molecule
         """
-        try:
-            from openbabel import openbabel, pybel
-        except:
-            import openbabel
-            import pybel
-
-        m1 = pybel.readstring("xyz", self.ref_mol.to("xyz"))
-        m2 = pybel.readstring("xyz", self.molecule.to("xyz"))
-        aligner = openbabel.OBAlign(True, False)
-        aligner.SetRefMol(m1.OBMol)
-        aligner.SetTargetMol(m2.OBMol)
-        aligner.Align()
-        print("RMSD: ", aligner.GetRMSD())
-        rot = np.zeros([3, 3])
-        for i in range(3):
-            for j in range(3):
-                rot[i, j] = aligner.GetRotMatrix().Get(i, j)
+        # Kabsch algorithm, atoms are assumed to be in the same order
+        center = np.mean(self.ref_mol.cart_coords, axis=0)
+        coord1 = self.ref_mol.cart_coords - center
         coord2 = self.molecule.cart_coords
         coord2 -= np.mean(coord2, axis=0)
-        coord3 = rot.dot(coord2.T).T + np.mean(self.ref_mol.cart_coords, axis=0)
+        U, _, Vt = np.linalg.svd(coord2.T.dot(coord1))
+        d = np.sign(np.linalg.det(Vt.T.dot(U.T)))
+        rot = Vt.T.dot(np.diag([1, 1, d])).dot(U.T)
+        coord3 = rot.dot(coord2.T).T
+        print("RMSD: ", np.sqrt(np.mean(np.sum((coord3 - coord1) ** 2, axis=1))))
+        coord3 += center
         self.mol_aligned = Molecule(self.ref_mol.atomic_numbers, coord3)
         self.ori = Orientation(rot)
 
@@ -491,6 +560,72 @@ class structure_from_ext:
             return display_molecules([self.ref_mol, self.molecule])
 
 
+def get_bond_cutoffs(z0, z1, tol=0.2, ignore_HH=True, max_bond_length=None):
+    """
+    Bond cutoffs for pairs of atoms, a pair is bonded if its distance
+    is shorter than the cutoff
+
+    Args:
+        z0: atomic numbers of the center atoms
+        z1: atomic numbers of the neighbor atoms
+        tol: tolerance value to check the connectivity
+        ignore_HH: whether or not ignore the short H-H in checking molecule
+        max_bond_length: sets maximum bond length if bond length is missing in bond length database
+
+    Returns:
+        an array of cutoffs
+    """
+    # same as CovalentBond.is_bonded
+    cutoffs = (1 + tol) * pmg_bond_table[z0, z1]
+    max_d = bond_table[z0, z1]
+    if max_bond_length is not None:
+        max_d = np.where(np.isnan(max_d), max_bond_length, max_d)
+    HH = (z0 == 1) & (z1 == 1)
+
+    # QZ: use our own bond distance lib as the cap, or alone if pymatgen has no data
+    cutoffs = np.where(np.isnan(cutoffs), bond_table[z0, z1], np.fmin(cutoffs, max_d))
+    # sometime the H-H short distance is not avoidable
+    cutoffs[HH] = 0.0 if ignore_HH else (1 + tol) * pmg_bond_table[1, 1]
+
+    missing = np.isnan(cutoffs)
+    if missing.any():
+        k = np.argmax(missing)
+        raise KeyError(f"{Element.from_Z(z1[k]).symbol:s}-{Element.from_Z(z0[k]).symbol:s}")
+    return cutoffs
+
+
+def _bfs(start, indptr, indices, images, visited, shifts):
+    """
+    Breadth-first search of the sites connected to the start site
+
+    Args:
+        start: index of the start site
+        indptr: CSR row pointers of the bond graph
+        indices: CSR column indices of the bond graph
+        images: periodic image of each bond
+        visited: boolean array of visited sites, updated in place
+        shifts: accumulated image of each site, updated in place
+
+    Returns:
+        indices of the connected sites in the visiting order
+    """
+    order = np.empty(len(visited), dtype=np.int64)
+    order[0] = start
+    visited[start] = True
+    head, tail = 0, 1
+    while head < tail:
+        i = order[head]
+        head += 1
+        for k in range(indptr[i], indptr[i + 1]):
+            j = indices[k]
+            if not visited[j]:
+                visited[j] = True
+                shifts[j] = shifts[i] + images[k]
+                order[tail] = j
+                tail += 1
+    return order[:tail]
+
+
 def search_molecules_in_crystal(struc, tol=0.2, once=False, ignore_HH=True, max_bond_length=None):
     """
     Function to perform to find the molecule in a Pymatgen structure
@@ -507,87 +642,67 @@ def search_molecules_in_crystal(struc, tol=0.2, once=False, ignore_HH=True, max_
         positions: list of center positions
     """
 
-    def check_one_layer(struc, sites0, visited):
-        new_members = []
-        for site0 in sites0:
-            sites_add, visited = check_one_site(struc, site0, visited)
-            new_members.extend(sites_add)
-        return new_members, visited
-
-    def check_one_site(struc, site0, visited, rmax=2.8):
-        neigh_sites = struc.get_neighbors(site0, rmax)
-        ids = [m.index for m in visited]
-        sites_add = []
-        ids_add = []
-        pbc = isinstance(struc, Structure)
-
-        for site1 in neigh_sites:
-            if site1.index not in ids + ids_add:
-                try:
-                    if CovalentBond.is_bonded(site0, site1, tol):
-                        if pbc:
-                            (d, image) = site0.distance_and_image(site1)
-                        else:
-                            d = site0.distance(site1)
-                        val1, val2 = site1.specie.value, site0.specie.value
-                        key = f"{val1:s}-{val2:s}"
-
-                        # sometime the H-H short distance is not avoidable
-                        if key == "H-H":
-                            if not ignore_HH:
-                                if pbc:
-                                    site1.frac_coords += image
-                                sites_add.append(site1)
-                                ids_add.append(site1.index)
-                        else:
-                            if d < bonds.get(key,max_bond_length):
-                                if pbc:
-                                    site1.frac_coords += image
-                                sites_add.append(site1)
-                                ids_add.append(site1.index)
-                except ValueError:
-                    # QZ: use our own bond distance lib
-                    if pbc:
-                        (d, image) = site0.distance_and_image(site1)
-                    else:
-                        d = site0.distance(site1)
-
-                    val1, val2 = site1.specie.value, site0.specie.value
-                    key = f"{val1:s}-{val2:s}"
-                    if d < bonds[key]:
-                        if pbc:
-                            site1.frac_coords += image
-                        sites_add.append(site1)
-                        ids_add.append(site1.index)
-
-        if len(sites_add) > 0:
-            visited.extend(sites_add)
-
-        return sites_add, visited
+    rmax = 2.8
+    pbc = isinstance(struc, Structure)
 
+    # collect the neighbor pairs, only the closest image of each neighbor is kept
+    if pbc:
+        all_neigh = struc.get_all_neighbors(rmax)
+    else:
+        all_neigh = [struc.get_neighbors(site, rmax) for site in struc.sites]
+
+    centers, points, dists, images = [], [], [], []
+    for i, neigh in enumerate(all_neigh):
+        if len(neigh) > 0:
+            idx = np.array([n.index for n in neigh])
+            d = np.array([n.nn_distance for n in neigh])
+            _, first = np.unique(idx, return_index=True)
+            seq = np.lexsort((d, idx))
+            _, start = np.unique(idx[seq], return_index=True)
+            keep = seq[start][np.argsort(first)]
+            centers.append(np.full(len(keep), i))
+            points.append(idx[keep])
+            dists.append(d[keep])
+            if pbc:
+                images.append(np.array([neigh[k].image for k in keep]))
+            else:
+                images.append(np.zeros([len(keep), 3]))
+
+    # bond graph in the CSR format, sites are visited in order
+    n = len(struc)
+    numbers = np.array(struc.atomic_numbers)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    indices = np.zeros(0, dtype=np.int64)
+    bond_images = np.zeros([0, 3])
+    if len(centers) > 0:
+        centers = np.concatenate(centers)
+        points = np.concatenate(points)
+        dists = np.concatenate(dists)
+        images = np.concatenate(images)
+
+        # check all pairs against the bond cutoffs at once
+        cutoffs = get_bond_cutoffs(numbers[centers], numbers[points], tol, ignore_HH, max_bond_length)
+        mask = dists < cutoffs
+
+        indptr[1:] = np.cumsum(np.bincount(centers[mask], minlength=n))
+        indices = points[mask].astype(np.int64)
+        bond_images = images[mask].astype(float)
+
+    # breadth-first search for the connected components
     molecules = []
-    visited_ids = []
-
-    for id, site in enumerate(struc.sites):
-        if id not in visited_ids:
-            first_site = site
-            visited = [first_site]
-            first_site.index = id
-            n_iter, max_iter = 0, len(struc) - len(visited_ids)
-            while n_iter < max_iter:
-                if n_iter == 0:
-                    new_sites, visited = check_one_site(struc, first_site, visited)
-                else:
-                    new_sites, visited = check_one_layer(struc, new_sites, visited)
-                n_iter += 1
-                if len(new_sites) == 0:
-                    break
-
-            coords = [s.coords for s in visited]
-            coords = np.array(coords)
-            numbers = [s.specie.number for s in visited]
-            molecules.append(Molecule(numbers, coords))
-            visited_ids.extend([s.index for s in visited])
+    visited = np.zeros(n, dtype=np.bool_)
+    shifts = np.zeros([n, 3])
+    # pymatgen rebuilds the coordinate arrays on every access
+    coords0 = struc.frac_coords if pbc else struc.cart_coords
+
+    for id in range(n):
+        if not visited[id]:
+            members = _bfs(id, indptr, indices, bond_images, visited, shifts)
+            if pbc:
+                coords = struc.lattice.get_cartesian_coords(coords0[members] + shifts[members])
+            else:
+                coords = coords0[members]
+            molecules.append(Molecule(numbers[members].tolist(), coords))
             # print(molecules[-1].to(fmt='xyz')); import sys; sys.exit()
         if once and len(molecules) == 1:
             break
@@ -1808,13 +1808,47 @@ def make_graph(mol, tol=0.2):
     return G
 
 
+_graph_cache = {}
+
+
+def get_graph_invariants(mol, ignore_name=False):
+    """
+    Bond graph of the molecule with its WL hash and Laplacian spectrum.
+    The results are cached by species and coordinates, since the same
+    reference molecule is compared against many candidates.
+
+    Args:
+        mol: pymatgen Molecule
+        ignore_name: whether or not ignore the element names in the hash
+
+    Returns:
+        the graph, the WL hash and the sorted Laplacian eigenvalues
+    """
+    key = (tuple(mol.atomic_numbers), mol.cart_coords.tobytes(), ignore_name)
+    if key not in _graph_cache:
+        if len(_graph_cache) >= 256:
+            _graph_cache.clear()
+        G = make_graph(mol)
+        wl = nx.weisfeiler_lehman_graph_hash(G, node_attr=None if ignore_name else "name")
+        A = nx.to_numpy_array(G)
+        # eigvalsh returns the eigenvalues sorted
+        spectrum = np.linalg.eigvalsh(np.diag(A.sum(axis=1)) - A)
+        _graph_cache[key] = (G, wl, spectrum)
+    return _graph_cache[key]
+
+
 def compare_mol_connectivity(mol1, mol2, ignore_name=False):
     """
     Compare two molecules by connectivity
     """
 
-    G1 = make_graph(mol1)
-    G2 = make_graph(mol2)
+    G1, wl1, spectrum1 = get_graph_invariants(mol1, ignore_name)
+    G2, wl2, spectrum2 = get_graph_invariants(mol2, ignore_name)
+
+    # isomorphic graphs always share the same WL hash and Laplacian spectrum
+    if wl1 != wl2 or not np.allclose(spectrum1, spectrum2, atol=1e-6):
+        return False, {}
+
     if ignore_name:
         GM = nx.isomorphism.GraphMatcher(G1, G2)
     else:
@@ -823,10 +823,8 @@ class mol_site:
                 aligner.SetTargetMol(m2.OBMol)
                 if aligner.Align():
                     print("RMSD: ", aligner.GetRMSD())
-                    rot = np.zeros([3, 3])
-                    for i in range(3):
-                        for j in range(3):
-                            rot[i, j] = aligner.GetRotMatrix().Get(i, j)
+                    M = aligner.GetRotMatrix()
+                    rot = np.array([[M.Get(i, j) for j in range(3)] for i in range(3)])
                     if abs(np.linalg.det(rot) - 1) < 1e-2:
                         self.orientation.matrix = rot
                         self.orientation.r = R.from_matrix(rot)
@@ -63,7 +63,7 @@ setup(
         "spglib>=2.5.0",
         "pymatgen>=2024.3.1",
         "pandas>=2.0.2",
-        "networkx>=2.3",
+        "networkx>=2.5",
         "ase>=3.23.0",
         "scipy>=1.7.3",
         "numpy>=1.26,<2",  # prevent the use of numpy2
@@ -6,11 +6,14 @@ import unittest
 import numpy as np
 import pymatgen.analysis.structure_matcher as sm
 from pymatgen.core import Lattice as pmg_Lattice
-from pymatgen.core import Structure
+from pymatgen.core import Molecule, Structure
 from pymatgen.core.operations import SymmOp
+from scipy.spatial.transform import Rotation
 
 from pyxtal import pyxtal
+from pyxtal.io import get_bond_cutoffs, get_cif_str_for_pyxtal, search_molecules_in_crystal, structure_from_ext
 from pyxtal.lattice import Lattice
+from pyxtal.molecule import pyxtal_molecule
 from pyxtal.operations import get_inverse
 from pyxtal.symmetry import Group, Hall, Wyckoff_position
 
@@ -186,6 +189,113 @@ class TestPartial(unittest.TestCase):
         assert s.valid
 
 
+class Test_search_molecules(unittest.TestCase):
+    def test_search(self):
+        # number of molecules, composition and mean intramolecular distance
+        refs = {
+            "aspirin": (4, {"H8 C9 O4": [3.6889]}),
+            "gdh": (12, {"H2 O1": [0.6788, 0.6824], "H5 C2 N1 O2": [2.0322]}),
+            "xxvi": (2, {"H22 C34 N2 Cl2 O2": [6.0824]}),
+        }
+        for name, (N, ref) in refs.items():
+            pmg = Structure.from_file(cif_path + name + ".cif")
+            for ignore_HH in [True, False]:
+                mols = search_molecules_in_crystal(pmg, tol=0.2, ignore_HH=ignore_HH)
+                assert len(mols) == N
+                for mol in mols:
+                    d = np.mean(mol.distance_matrix)
+                    assert np.abs(np.array(ref[mol.composition.formula]) - d).min() < 1e-3
+
+        pmg = Structure.from_file(cif_path + "gdh.cif")
+        assert len(search_molecules_in_crystal(pmg, tol=0.2, once=True)) == 1
+
+    def test_search_HH(self):
+        # two H2 molecules, both as a Molecule and in a periodic box
+        coords = [[0, 0, 0], [0.74, 0, 0], [5, 0, 0], [5.74, 0, 0]]
+        mol = Molecule(["H"] * 4, coords)
+        pmg = Structure(pmg_Lattice.cubic(10), ["H"] * 4, np.array(coords) + 1, coords_are_cartesian=True)
+        for struc in [mol, pmg]:
+            mols = search_molecules_in_crystal(struc, tol=0.2, ignore_HH=True)
+            assert [len(m) for m in mols] == [1, 1, 1, 1]
+            mols = search_molecules_in_crystal(struc, tol=0.2, ignore_HH=False)
+            assert [len(m) for m in mols] == [2, 2]
+            assert np.allclose(mols[1].cart_coords[1] - mols[1].cart_coords[0], [0.74, 0, 0])
+
+    def test_search_molecule(self):
+        ref = pyxtal_molecule("aspirin").mol
+        coords = np.vstack([ref.cart_coords, ref.cart_coords + 10.0])
+        mols = search_molecules_in_crystal(Molecule(ref.species * 2, coords), tol=0.2)
+        assert len(mols) == 2
+        for mol in mols:
+            assert mol.composition == ref.composition
+            assert np.allclose(np.sort(mol.distance_matrix, axis=None), np.sort(ref.distance_matrix, axis=None))
+
+    def test_bond_cutoffs(self):
+        z = np.array([1, 6])
+        assert np.allclose(get_bond_cutoffs(z, z, ignore_HH=True), [0, 1.848])
+        assert get_bond_cutoffs(z, z, ignore_HH=False)[0] > 0
+
+
+class Test_cif(unittest.TestCase):
+    def parse(self, cif):
+        symbol = cif.split("_symmetry_space_group_name_H-M '")[1].split("'")[0]
+        block = cif.split("_symmetry_equiv_pos_as_xyz\n")[1].split("\nloop_")[0]
+        ops = [line.split(" ", 1)[1].strip("'") for line in block.split("\n") if len(line) > 0]
+        rows = cif.split("_atom_site_occupancy\n")[1].split("#END")[0].splitlines()
+        return symbol, ops, rows
+
+    def test_standard(self):
+        c = pyxtal()
+        c.from_random(3, 225, ["C"], [4], random_state=1)
+        symbol, ops, rows = self.parse(get_cif_str_for_pyxtal(c))
+        assert symbol == "Fm-3m"
+        assert ops == [op.as_xyz_str() for op in Group(225)[0]]
+        assert len(rows) == len(c.atom_sites)
+
+    def test_hall(self):
+        for hn, ref in [(82, "P 1 21/n 1"), (91, "A 1 2/n 1")]:
+            c = pyxtal()
+            c.from_random(3, hn, ["C", "O"], [8, 4], use_hall=True, random_state=1)
+            symbol, ops, rows = self.parse(get_cif_str_for_pyxtal(c))
+            assert symbol == ref
+            assert ops == [op.as_xyz_str() for op in c.group[0]]
+            assert ops != [op.as_xyz_str() for op in Group(c.group.number)[0]]
+            pmg = Structure.from_str(c.to_file(), fmt="cif")
+            assert sm.StructureMatcher().fit(c.to_pymatgen(), pmg)
+
+    def test_sym_num(self):
+        c = pyxtal(molecular=True)
+        c.from_random(3, 14, ["aspirin"], random_state=1)
+        symbol, ops, rows = self.parse(get_cif_str_for_pyxtal(c, sym_num=4))
+        assert symbol == "P1"
+        assert ops == ["x, y, z"]
+        assert len(rows) == 4 * len(c.molecules[0].mol)
+
+    def test_cluster(self):
+        c = pyxtal()
+        c.from_random(0, "Ih", ["C"], [60], random_state=1)
+        symbol, ops, rows = self.parse(get_cif_str_for_pyxtal(c))
+        assert len(ops) == 120
+        assert len(rows) == 1
+
+
+class Test_align(unittest.TestCase):
+    def test_align(self):
+        ref = pyxtal_molecule("aspirin").mol
+        R = Rotation.random(random_state=1).as_matrix()
+        coords = (ref.cart_coords - ref.center_of_mass).dot(R.T) + 5.0
+
+        # align() is not called anywhere in pyxtal, and structure_from_ext.__init__
+        # never sets ref_mol or molecule, so both are set by hand on a bare object
+        struc = structure_from_ext.__new__(structure_from_ext)
+        struc.ref_mol = ref
+        struc.molecule = Molecule(ref.species, coords)
+        struc.align()
+        assert np.allclose(struc.mol_aligned.cart_coords, ref.cart_coords)
+        assert np.allclose(struc.ori.matrix, R.T)
+        assert np.isclose(np.linalg.det(struc.ori.matrix), 1.0)
+
+
 class Test_resort(unittest.TestCase):
     def test_molecule(self):
         rng = np.random.default_rng(0)
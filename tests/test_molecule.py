@@ -9,7 +9,7 @@ from pymatgen.symmetry.analyzer import SpacegroupAnalyzer
 
 from pyxtal import pyxtal
 from pyxtal.lattice import Lattice
-from pyxtal.molecule import pyxtal_molecule
+from pyxtal.molecule import compare_mol_connectivity, pyxtal_molecule
 from pyxtal.symmetry import Group, Wyckoff_position
 
 
@@ -33,6 +33,18 @@ class TestMolecule(unittest.TestCase):
         assert len(m.get_orientations_in_wp(g[1])) == 1
         assert len(m.get_orientations_in_wp(g[2])) == 1
 
+    def test_compare_mol_connectivity(self):
+        mol1 = pyxtal_molecule("aspirin").mol
+        mol2 = mol1.copy()
+        match, mapping = compare_mol_connectivity(mol1, mol2)
+        assert match
+        assert len(mapping) == len(mol1)
+
+        # detach one H atom to break the connectivity
+        mol2.translate_sites([len(mol2) - 1], [5.0, 5.0, 5.0])
+        match, _ = compare_mol_connectivity(mol1, mol2)
+        assert not match
+
 
 class TestMolecular(unittest.TestCase):
     def test_single_specie(self):